@@ -1,92 +1,149 @@
 import streamlit as st
-import requests
-from bs4 import BeautifulSoup
-import re
+import asyncio
+import atexit
+import aiohttp
+import cachetools
+import concurrent.futures
+import functools
+import threading
+from bs4 import BeautifulSoup, Tag
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
 from dataclasses import dataclass
-from typing import List, Tuple, Optional
-import json
+from typing import Dict, List, Tuple, Optional
+from urllib.parse import urlparse
+import orjson
 from datetime import datetime, timedelta
 import random
 
-@dataclass
+# Every ASCII byte except digits, ',' and '.'; non-ASCII is dropped by the encode step
+PRICE_STRIP_BYTES = bytes(c for c in range(128) if chr(c) not in '0123456789,.')
+META_PRICE_ATTRIBUTES = (
+    ("name", "twitter:data1"),
+    ("property", "og:price:amount"),
+    ("property", "product:price:amount"),
+)
+META_PRICE_SELECTORS = tuple(f'meta[{attr}="{value}"]' for attr, value in META_PRICE_ATTRIBUTES)
+SCHEMA_PRICE_SELECTOR = 'span[itemprop="price"]'
+JSON_LD_SELECTOR = 'script[type="application/ld+json"]'
+PRICE_CLASSES = frozenset(('price', 'product-price', 'regular-price', 'sales-price', 'current-price', 'woocommerce-Price-amount'))
+
+
+@dataclass(slots=True)
 class Product:
     url: str
     competitors: List[str]
     last_updated: datetime
 
 
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
+)
+BYPASS_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Referer': 'https://www.google.com/',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+
 def get_random_headers():
-    user_agents = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
-    ]
-
-    headers = {
-        'User-Agent': random.choice(user_agents),
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Referer': 'https://www.google.com/',
-        'DNT': '1',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-    }
+    headers = BYPASS_HEADERS.copy()
+    headers['User-Agent'] = random.choice(USER_AGENTS)
     return headers
 
 
+# Specialised price lookups for retailers that are compared often, keyed by host without "www.".
+# They run on the streamed head and outrank the generic META_PRICE_ATTRIBUTES priority for that host.
+EXTRACTORS: Dict[str, etree.XPath] = {
+    'bol.com': etree.XPath('//meta[@property="product:price:amount"]/@content'),
+}
+
+
+def site_host(url: str) -> str:
+    return (urlparse(url).hostname or '').removeprefix('www.')
+
+
 def extract_price(html_content, url):
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # Fast paths only need a few nodes, so query them without building a BeautifulSoup tree
+    tree = LexborHTMLParser(html_content)
 
     # 1. Check meta tags
-    meta_tags = [
-        ("meta", {"name": "twitter:data1"}),
-        ("meta", {"property": "og:price:amount"}),
-        ("meta", {"property": "product:price:amount"}),
-    ]
-    for tag, attrs in meta_tags:
-        meta_price = soup.find(tag, attrs)
+    for selector in META_PRICE_SELECTORS:
+        meta_price = tree.css_first(selector)
         if meta_price:
-            return parse_price(meta_price.get("content"))
+            return parse_price((meta_price.attributes.get("content") or "").strip())
 
     # 2. Check Schema.org microdata
-    schema_price = soup.find("span", itemprop="price")
+    schema_price = tree.css_first(SCHEMA_PRICE_SELECTOR)
     if schema_price:
-        return parse_price(schema_price.text)
+        return parse_price(schema_price.text().strip())
 
     # 3. Check JSON-LD
-    json_ld = soup.find("script", type="application/ld+json")
-    if json_ld:
-        try:
-            data = json.loads(json_ld.string)
-            if isinstance(data, list):
-                data = data[0]
-            if "offers" in data and "price" in data["offers"]:
-                return parse_price(data["offers"]["price"])
-        except json.JSONDecodeError:
-            pass
+    found, json_ld_price = find_price_in_json_ld(tree)
+    if found:
+        return json_ld_price
 
     # 4. Fallback to HTML structure
+    soup = BeautifulSoup(html_content, 'lxml')
     return find_price_in_html(soup)
 
 
+def find_price_in_json_ld(tree) -> Tuple[bool, Optional[float]]:
+    # Returns (found, price); like the meta and microdata checks, the first offers.price settles the lookup
+    # Sites often emit several blocks (Organization, BreadcrumbList, Product), so check them all
+    for script in tree.css(JSON_LD_SELECTOR):
+        try:
+            data = orjson.loads(script.text() or b"{}")
+        except orjson.JSONDecodeError:
+            continue
+
+        # Walk lists, @graph and nested objects in document order looking for offers.price
+        stack = [data]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, list):
+                stack.extend(reversed(item))
+            elif isinstance(item, dict):
+                offers = item.get("offers")
+                offer_prices = [
+                    offer["price"] for offer in (offers if isinstance(offers, list) else [offers])
+                    if isinstance(offer, dict) and "price" in offer
+                ]
+                if offer_prices:
+                    # Within one list of offers, take the first price that parses
+                    for offer_price in offer_prices:
+                        price = parse_price(str(offer_price).strip())
+                        if price is not None:
+                            return True, price
+                    return True, None
+                stack.extend(reversed([value for value in item.values() if isinstance(value, (dict, list))]))
+
+    return False, None
+
+
 def find_price_in_html(soup):
     # First, try to find the price near the H1 tag
     h1 = soup.find('h1')
     if h1:
         # Search for price within the next 5 siblings of H1
-        for sibling in h1.find_next_siblings()[:5]:
+        for sibling in h1.find_next_siblings(limit=5):
             price = extract_price_from_element(sibling)
             if price:
                 return price
 
-    # If not found near H1, search for common price classes
-    price_classes = ['price', 'product-price', 'regular-price', 'sales-price', 'current-price', 'woocommerce-Price-amount']
-    for class_name in price_classes:
-        price_elem = soup.find(class_=class_name)
-        if price_elem:
-            price = extract_price_from_element(price_elem)
-            if price:
-                return price
+    # If not found near H1, take the first element with a common price class in document order
+    for element in soup.descendants:
+        classes = element.get('class') if isinstance(element, Tag) else None
+        if not classes or PRICE_CLASSES.isdisjoint(classes):
+            continue
+        price = extract_price_from_element(element)
+        if price:
+            return price
 
     return None
 
@@ -95,9 +152,11 @@ def extract_price_from_element(element):
     return parse_price(element.text.strip())
 
 
-def parse_price(price_str):
-    price_str = re.sub(r'[^\d,.]', '', price_str)
-    price_str = price_str.replace(',', '.')
+# Callers pass stripped strings so the same price text always hits the same cache entry
+@functools.lru_cache(maxsize=1024)
+def parse_price(price_str: str):
+    price_str = price_str.encode('ascii', 'ignore').translate(None, PRICE_STRIP_BYTES)
+    price_str = price_str.replace(b',', b'.')
     try:
         price = float(price_str)
         return price if price >= 1.01 else None
@@ -105,60 +164,200 @@ def parse_price(price_str):
         return None
 
 
-def fetch_price(url: str) -> Tuple[Optional[float], Optional[str]]:
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+STREAM_CHUNK_SIZE = 8192
+PARSE_WORKERS = 16
+PRICE_CACHE_TTL = timedelta(minutes=5)
+PRICE_CACHE_SIZE = 4096
+PROGRESS_STEPS = 10
+
+
+class StreamingPriceScanner:
+    """Incrementally parses the <head> of a downloading page for the price meta tag extract_price checks first.
+
+    extract_price takes the first META_PRICE_ATTRIBUTES[0] tag anywhere in the page over every other
+    meta tag, so only that tag settles the price while streaming. A lower-priority tag could still be
+    overridden by one further down (libxml2 may also close the head earlier than Lexbor does), so those
+    pages are left to extract_price. Parsing stops once the head ends.
+    """
+
+    def __init__(self, host_xpath: Optional[etree.XPath] = None):
+        self.parser = etree.HTMLPullParser(events=("start", "end"), tag=("head", "meta", "body"))
+        self.host_xpath = host_xpath
+        self.done = False
+
+    def host_price(self, element) -> Optional[float]:
+        # Evaluated only where the generic scan stops, so a host lookup never reads further
+        if self.host_xpath is None:
+            return None
+        for value in self.host_xpath(element):
+            price = parse_price(str(value).strip())
+            if price is not None:
+                return price
+        return None
+
+    def feed(self, chunk: bytes) -> Optional[float]:
+        if self.done:
+            return None
+
+        top_attr, top_value = META_PRICE_ATTRIBUTES[0]
+        self.parser.feed(chunk)
+        for event, element in self.parser.read_events():
+            if event == "start" and element.tag == "meta":
+                if element.get(top_attr) == top_value:
+                    self.done = True
+                    price = self.host_price(element)
+                    if price is None:
+                        price = parse_price((element.get("content") or "").strip())
+                    return price
+            elif (event == "end" and element.tag == "head") or (event == "start" and element.tag == "body"):
+                self.done = True
+                return self.host_price(element)
+
+        return None
+
+
+async def fetch_page(session: aiohttp.ClientSession, url: str, headers: Optional[dict] = None) -> Tuple[Optional[float], Optional[str]]:
+    # Stream the body and stop downloading once the head has settled the price.
+    # Returns (price, None) on an early hit, (None, html) otherwise and (None, None) for non-HTML responses.
+    async with session.get(url, headers=headers, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        # Mis-linked PDFs and images are rejected before any of the body is read
+        if 'html' not in response.content_type:
+            return None, None
+        scanner = StreamingPriceScanner(EXTRACTORS.get(site_host(url)))
+        chunks = []
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            price = scanner.feed(chunk)
+            if price is not None:
+                response.close()
+                return price, None
+            chunks.append(chunk)
+
+        body = b"".join(chunks)
+        try:
+            return None, body.decode(response.charset or "utf-8", errors="replace")
+        except LookupError:
+            # Unknown or misspelled charset in Content-Type
+            return None, body.decode("utf-8", errors="replace")
+
+
+async def fetch_price_async(session: aiohttp.ClientSession, url: str) -> Tuple[Optional[float], Optional[str]]:
     if not url:
         return None, None
 
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        price = extract_price(response.text, url)
+        try:
+            price, html_content = await fetch_page(session, url)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 403:
+                return None, f"Error fetching URL: {str(e)}"
+            # Retry with more advanced headers
+            try:
+                price, html_content = await fetch_page(session, url, headers=get_random_headers())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return None, f"Error fetching URL (with bypass): {str(e) or 'request timed out'}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return None, f"Error fetching URL: {str(e) or 'request timed out'}"
+
+        if price is None and html_content is None:
+            return None, "Non-HTML response"
+        if price is None:
+            price = await asyncio.get_running_loop().run_in_executor(None, extract_price, html_content, url)
         if price is None:
             return None, "Price not found on the page or below 1.01 euro"
         return price, None
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 403:
-            # Retry with more advanced headers
-            try:
-                response = requests.get(url, headers=get_random_headers(), timeout=10)
-                response.raise_for_status()
-                price = extract_price(response.text, url)
-                if price is None:
-                    return None, "Price not found on the page or below 1.01 euro"
-                return price, None
-            except requests.exceptions.RequestException as e:
-                return None, f"Error fetching URL (with bypass): {str(e)}"
-        return None, f"Error fetching URL: {str(e)}"
     except Exception as e:
         return None, f"Unexpected error: {str(e)}"
 
 
-def compare_prices(product: Product, progress_bar):
-    results = []
-    errors = []
-    total_urls = len(product.competitors) + 1
-
-    # Fetch product price
-    progress_bar.progress(0)
-    own_price, own_error = fetch_price(product.url)
-    results.append((product.url, own_price))
-    errors.append((product.url, own_error))
-    progress_bar.progress(1 / total_urls)
-
-    # Fetch competitor prices
-    for i, comp_url in enumerate(product.competitors):
-        if not comp_url:
-            results.append((comp_url, None))
-            errors.append((comp_url, None))
-            continue
+@dataclass(slots=True)
+class Fetcher:
+    loop: asyncio.AbstractEventLoop
+    session: aiohttp.ClientSession
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        if not self.loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def shutdown(self) -> None:
+        await self.session.close()
+        await self.loop.shutdown_default_executor()
+
+
+def run_fetch_loop(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+    loop.close()
+
+
+@st.cache_resource(on_release=lambda fetcher: fetcher.close())
+def get_fetcher() -> Fetcher:
+    # Long-lived loop so the shared HTTP session survives Streamlit reruns
+    loop = asyncio.new_event_loop()
+    # Pages are parsed on worker threads so the loop keeps reading other responses meanwhile
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix="price-parse"))
+    threading.Thread(target=run_fetch_loop, args=(loop,), name="price-fetch-loop", daemon=True).start()
 
-        comp_price, comp_error = fetch_price(comp_url)
-        results.append((comp_url, comp_price))
-        errors.append((comp_url, comp_error))
-        progress_bar.progress((i + 2) / total_urls)
+    async def create_session():
+        # Keep-alive pool and cached DNS answers are shared by every comparison in the process
+        connector = aiohttp.TCPConnector(limit=64, use_dns_cache=True, ttl_dns_cache=300, enable_cleanup_closed=True)
+        # No cookie jar: every fetch stays stateless, as with the old per-request calls
+        return aiohttp.ClientSession(headers=DEFAULT_HEADERS, connector=connector, cookie_jar=aiohttp.DummyCookieJar())
 
-    progress_bar.progress(1.0)
+    fetcher = Fetcher(loop, asyncio.run_coroutine_threadsafe(create_session(), loop).result())
+    # "Clear caches" releases the fetcher through on_release, which also drops this hook
+    atexit.register(fetcher.close)
+    return fetcher
+
+
+@st.cache_resource
+def get_price_cache() -> Tuple[cachetools.TTLCache, threading.Lock]:
+    # Prices fetched in the last PRICE_CACHE_TTL, shared by all reruns and sessions.
+    # Expired and least recently used entries are evicted, so memory stays bounded.
+    cache = cachetools.TTLCache(maxsize=PRICE_CACHE_SIZE, ttl=PRICE_CACHE_TTL.total_seconds())
+    return cache, threading.Lock()
+
+
+def compare_prices(product: Product, progress_bar):
+    urls = [product.url] + product.competitors
+    fetcher = get_fetcher()
+    cache, cache_lock = get_price_cache()
+
+    # Fetch the product and all competitor prices concurrently on the shared session,
+    # skipping URLs whose price was fetched recently
+    outcomes = [(None, None)] * len(urls)
+    futures = {}
+    for i, url in enumerate(urls):
+        with cache_lock:
+            cached_price = cache.get(url)
+        if cached_price is not None:
+            outcomes[i] = (cached_price, None)
+        else:
+            futures[asyncio.run_coroutine_threadsafe(fetch_price_async(fetcher.session, url), fetcher.loop)] = i
+
+    # Each progress update is a websocket message, so only send one per PROGRESS_STEPS step
+    done = len(urls) - len(futures)
+    reported_step = done * PROGRESS_STEPS // len(urls)
+    progress_bar.progress(reported_step / PROGRESS_STEPS)
+    for future in concurrent.futures.as_completed(futures):
+        i = futures[future]
+        outcomes[i] = future.result()
+        if outcomes[i][0] is not None:
+            with cache_lock:
+                cache[urls[i]] = outcomes[i][0]
+        done += 1
+        step = done * PROGRESS_STEPS // len(urls)
+        if step > reported_step:
+            progress_bar.progress(step / PROGRESS_STEPS)
+            reported_step = step
+
+    results = [(url, price) for url, (price, _) in zip(urls, outcomes)]
+    errors = [(url, error) for url, (_, error) in zip(urls, outcomes)]
     return results, errors
 
 
@@ -169,7 +368,7 @@ def analyze_results(product: Product, prices: List[Tuple[str, Optional[float]]],
     if own_price is None:
         return f"Unable to fetch price for your product ([{product.url}]({product.url}))\nError: {own_error}"
 
-    analysis = f"**Your product:** [Product link]({product.url})\n\nYour price: €{own_price:.2f}\n\n"
+    parts = [f"**Your product:** [Product link]({product.url})", "", f"Your price: €{own_price:.2f}", "", ""]
     cheaper_count = 0
     equal_count = 0
 
@@ -228,17 +427,17 @@ def analyze_results(product: Product, prices: List[Tuple[str, Optional[float]]],
     valid_competitor_count = sum(1 for _, price in competitor_prices if price is not None)
     if valid_competitor_count > 0:
         if cheaper_count == valid_competitor_count:
-            analysis += "\n:green[You have the lowest price!]"
+            parts.append(":green[You have the lowest price!]")
         elif cheaper_count + equal_count == valid_competitor_count:
-            analysis += "\n:orange[Your price is the same as or lower than all competitors.]"
+            parts.append(":orange[Your price is the same as or lower than all competitors.]")
         elif cheaper_count > 0:
-            analysis += f"\n:yellow[You are cheaper than {cheaper_count} out of {valid_competitor_count} competitors.]"
+            parts.append(f":yellow[You are cheaper than {cheaper_count} out of {valid_competitor_count} competitors.]")
         else:
-            analysis += "\n:red[Your price is higher than all competitors.]"
+            parts.append(":red[Your price is higher than all competitors.]")
     else:
-        analysis += "\nUnable to compare with competitors due to price fetch errors."
+        parts.append("Unable to compare with competitors due to price fetch errors.")
 
-    return analysis
+    return "\n".join(parts)
 
 
 def main():
@@ -301,9 +500,12 @@ def main():
             elif product.url:
                 st.warning(f"Product {i+1} needs at least one competitor URL to compare.")
 
-    # Clean up old products (older than 1 month)
-    one_month_ago = datetime.now() - timedelta(days=30)
-    st.session_state.products = [p for p in st.session_state.products if p.last_updated > one_month_ago]
+    # Clean up old products (older than 1 month), at most once an hour
+    now = datetime.now()
+    if 'last_cleanup' not in st.session_state or now - st.session_state.last_cleanup > timedelta(hours=1):
+        one_month_ago = now - timedelta(days=30)
+        st.session_state.products[:] = [p for p in st.session_state.products if p.last_updated > one_month_ago]
+        st.session_state.last_cleanup = now
 
 
 if __name__ == "__main__":